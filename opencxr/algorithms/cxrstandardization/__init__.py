@@ -5,6 +5,8 @@ Created on Fri July  2 2021
 @author: keelin
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import opencxr
 from opencxr.algorithms.base_algorithm import BaseAlgorithm
@@ -50,35 +52,102 @@ class CXRStandardizationAlgorithm(BaseAlgorithm):
             norm_img_np,
             new_spacing,
             size_changes_in_norm,
+            lung_mask_np,
         ) = Normalizer.do_full_normalization(image_np, spacing, self.lung_seg_alg)
 
-        if (
-            np.max(norm_img_np) == 0
-        ):  # if we didn't get a valid lung segmentation then an empty image comes back:
+        return self.crop_and_resize(
+            norm_img_np,
+            new_spacing,
+            size_changes_in_norm,
+            lung_mask_np,
+            do_crop_to_lung_box,
+            final_square_size,
+        )
+
+    def run_batch(
+        self,
+        images_np,
+        spacings,
+        do_crop_to_lung_box=True,
+        final_square_size=1024,
+        batch_size=4,
+    ):
+        """
+        Runs standardization algorithm on a list of images
+        The images are processed in chunks of batch_size: the lung segmentations of a chunk are done as a single batch
+        and the per-image work is run concurrently
+        Args:
+            images_np: list of np arrays, x, y ordering
+            spacings: list of spacings (tuple or list of spacing values), one per image
+            do_crop_to_lung_box: boolean to indicate whether to crop around the lung segmentation
+            final_square_size: The size (pixels) of the final output images (aspect ratio preserved, short side padded)
+            batch_size: The maximum number of images to process at once (bounds the memory use)
+
+        Returns:
+            A list with, per image, the standard_image, new_spacing and size_changes as returned by run()
+        """
+        standard_results = []
+        for start in range(0, len(images_np), batch_size):
+            # normalize intensities of the images of this chunk
+            norm_results = Normalizer.do_full_normalization_batch(
+                images_np[start : start + batch_size],
+                spacings[start : start + batch_size],
+                self.lung_seg_alg,
+                batch_size,
+            )
+
+            with ThreadPoolExecutor(max_workers=Normalizer.batch_workers) as executor:
+                standard_results.extend(
+                    executor.map(
+                        lambda norm_result: self.crop_and_resize(
+                            *norm_result, do_crop_to_lung_box, final_square_size
+                        ),
+                        norm_results,
+                    )
+                )
+
+        return standard_results
+
+    def crop_and_resize(
+        self,
+        norm_img_np,
+        new_spacing,
+        size_changes_in_norm,
+        lung_mask_np,
+        do_crop_to_lung_box,
+        final_square_size,
+    ):
+        """
+        Optionally crops a normalized image around the lungs, then resizes it to the final square size
+        Args:
+            norm_img_np: the normalized image, as returned by Normalizer.do_full_normalization
+            new_spacing: the spacing of the normalized image
+            size_changes_in_norm: the size changes carried out during normalization
+            lung_mask_np: the lung segmentation of the normalized image
+            do_crop_to_lung_box: boolean to indicate whether to crop around the lung segmentation
+            final_square_size: The size (pixels) of the final output image (aspect ratio preserved, short side padded)
+
+        Returns:
+            standard_image, new_spacing, size_changes as described in run()
+        """
+        # resize in single precision, the output is clipped to 12 bits anyway
+        norm_img_np = norm_img_np.astype(np.float32, copy=False)
+
+        # if we didn't get a valid lung segmentation then an empty image comes back:
+        is_empty = not np.any(norm_img_np)
+        if is_empty:
             # then we won't do cropping to lung box - it will cause errors and makes  no sense anyway!
             do_crop_to_lung_box = False
 
-        if (
-            not do_crop_to_lung_box
-        ):  # no cropping to lungs, just resize to specified size and exit
-            # resize it to square specified size
-            (
-                norm_np_resized,
-                newest_spacing,
-                size_changes_square_pad,
-            ) = resize_long_edge_and_pad_to_square(
-                norm_img_np, new_spacing, final_square_size
-            )
-            norm_np_resized = np.clip(norm_np_resized, 0, 4095).astype(np.uint16)
-            # and join all the size changes that were made, in order
-            size_changes_final = size_changes_in_norm + size_changes_square_pad
-            return norm_np_resized, newest_spacing, size_changes_final
+        # collect all the size changes that are made, in order
+        size_changes_final = list(size_changes_in_norm)
 
-        elif (
+        # without cropping to lungs the whole normalized image is resized
+        lung_cropped_np = norm_img_np
+        if (
             do_crop_to_lung_box
         ):  # if we found a valid std image and we are supposed to crop to lungs
-            # segment lungs on normalized image
-            lung_mask_np = self.lung_seg_alg.run(norm_img_np)
+            # reuse the lung segmentation from the normalization, it is on the same grid as the normalized image
             if (
                 not np.max(lung_mask_np) == 0
             ):  # if all is good and we found a lung segmentation
@@ -89,37 +158,38 @@ class CXRStandardizationAlgorithm(BaseAlgorithm):
                 lung_cropped_np, size_changes_lung_crop = crop_to_mask(
                     norm_img_np, new_spacing, lung_mask_np, margin_in_mm=15.0
                 )
-
-                # now resize the normalized image to max dim specified, preserving aspect ratio and padding to square img.
-                (
-                    final_lung_cropped_resized,
-                    newest_spacing,
-                    size_changes_square_pad,
-                ) = resize_long_edge_and_pad_to_square(
-                    lung_cropped_np, new_spacing, final_square_size
-                )
-                final_lung_cropped_resized = np.clip(
-                    final_lung_cropped_resized, 0, 4095
-                ).astype(np.uint16)
-                # and join all the size changes that were made, in order
-                size_changes_final = (
-                    size_changes_in_norm
-                    + size_changes_lung_crop
-                    + size_changes_square_pad
-                )
-                return final_lung_cropped_resized, newest_spacing, size_changes_final
+                size_changes_final.extend(size_changes_lung_crop)
 
             else:  # no valid lung segmentation found, return an empty image
-                # resize it to square specified size
-                norm_img_np.fill(0)
-                (
-                    norm_np_resized,
-                    newest_spacing,
-                    size_changes_square_pad,
-                ) = resize_long_edge_and_pad_to_square(
-                    norm_img_np, new_spacing, final_square_size
-                )
-                norm_np_resized = np.clip(norm_np_resized, 0, 4095).astype(np.uint16)
-                # and join all the size changes that were made, in order
-                size_changes_final = size_changes_in_norm + size_changes_square_pad
-                return norm_np_resized, newest_spacing, size_changes_final
+                lung_cropped_np = np.zeros_like(norm_img_np)
+                is_empty = True
+
+        # now resize the image to max dim specified, preserving aspect ratio and padding to square img.
+        # (an empty image stays empty, so then the cheapest resize, without anti-aliasing or interpolation, will do)
+        (
+            final_resized,
+            newest_spacing,
+            size_changes_square_pad,
+        ) = resize_long_edge_and_pad_to_square(
+            lung_cropped_np,
+            new_spacing,
+            final_square_size,
+            anti_aliasing=not is_empty,
+            interp_order=0 if is_empty else 1,
+        )
+        final_resized = self.clip_to_output_range(final_resized)
+        size_changes_final.extend(size_changes_square_pad)
+
+        return final_resized, newest_spacing, size_changes_final
+
+    def clip_to_output_range(self, img_np):
+        """
+        Clips a (float) image to the output intensity range 0-4095, in place, and converts it to uint16
+        Args:
+            img_np: np array image to clip, it is modified
+
+        Returns:
+            the clipped image as uint16
+        """
+        np.clip(img_np, 0, 4095, out=img_np)
+        return img_np.astype(np.uint16, copy=False)
@@ -134,11 +134,13 @@ class LungSegmentationAlgorithm(BaseAlgorithm):
 
         return resized_seg_map
 
-    def run(self, image):
+    def prepare_image(self, image):
         """
-        The call to run lung segmentation on an image
+        Prepare an image for input to the model
         :param image: The input image as np array, x, y ordering (eg from utils file_io read_file)
-        :return: The segmentation image as np array, same size as input image
+        :return: The preprocessed 512x512 image, y, x ordering
+                 The shape of the (transposed) input image
+                 The list of size changes carried out to get to 512x512 (see utils __init__.py)
         """
         # transpose because lung segmentation model requires y, x ordering
         image = np.transpose(image)
@@ -155,9 +157,17 @@ class LungSegmentationAlgorithm(BaseAlgorithm):
         )
         # do some basic preprocessing
         resized_img = self.preprocess(resized_img)
-        # get the segmentation in size 512
-        seg_map = self.process_image(resized_img)
 
+        return resized_img, orig_img_shape, size_changes
+
+    def postprocess_segmentation(self, seg_map, orig_img_shape, size_changes):
+        """
+        Bring a 512x512 segmentation from the model back to the size and ordering of the input image
+        :param seg_map: np array 512x512 of lung segmentation (from process_image)
+        :param orig_img_shape: the shape of the (transposed) input image, as returned by prepare_image
+        :param size_changes: the size changes returned by prepare_image
+        :return: The segmentation image as np array, same size as input image
+        """
         # if the seg map has nothing segmented then future rescaling operations will fail so we return immediately in that case
         if np.max(seg_map) == 0:
             return np.zeros(orig_img_shape).astype(np.uint8)
@@ -170,3 +180,32 @@ class LungSegmentationAlgorithm(BaseAlgorithm):
         seg_original = np.transpose(seg_original)
 
         return seg_original
+
+    def run(self, image):
+        """
+        The call to run lung segmentation on an image
+        :param image: The input image as np array, x, y ordering (eg from utils file_io read_file)
+        :return: The segmentation image as np array, same size as input image
+        """
+        resized_img, orig_img_shape, size_changes = self.prepare_image(image)
+        # get the segmentation in size 512
+        seg_map = self.process_image(resized_img)
+
+        return self.postprocess_segmentation(seg_map, orig_img_shape, size_changes)
+
+    def run_batch(self, images):
+        """
+        Run lung segmentation on several images with a single call to the model
+        :param images: list of input images as np arrays, x, y ordering (eg from utils file_io read_file)
+        :return: list of segmentation images as np arrays, each the same size as its input image
+        """
+        prepared = [self.prepare_image(image) for image in images]
+        # stack the 512x512 inputs so the model sees them as one batch
+        seg_maps = self.process_image(np.stack([p[0] for p in prepared]))
+        # process_image squeezes its output, so restore the batch axis for a batch of one
+        seg_maps = seg_maps.reshape((len(prepared),) + seg_maps.shape[-2:])
+
+        return [
+            self.postprocess_segmentation(seg_map, orig_img_shape, size_changes)
+            for seg_map, (_, orig_img_shape, size_changes) in zip(seg_maps, prepared)
+        ]
@@ -3,11 +3,21 @@
 @author: keelin
 """
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from opencxr.utils.mask_crop import crop_img_borders
 from opencxr.utils.resize_rescale import resize_preserve_aspect_ratio
 from scipy import ndimage
 
+try:
+    # cupy is optional, if it is installed the energy band work can be done on the GPU (see Normalizer.use_gpu)
+    import cupy
+    from cupyx.scipy import ndimage as cupy_ndimage
+except ImportError:
+    cupy = None
+
 
 class Normalizer:
     """
@@ -17,35 +27,141 @@ class Normalizer:
 
     In general users of opencxr need only access method do_full_normalization()
 
+    If cupy is installed the energy band computations can be run on the GPU by setting Normalizer.use_gpu = True
+    (off by default: the lung segmentation model may already have reserved most of the GPU memory). The results
+    match the CPU path to within a mean absolute difference of 0.5 and a maximum of 5 (on the 0-4095 range), see
+    test_normalization_gpu in tests/test_utils.py (skipped if cupy is not installed). The energy bands then stay on the GPU between the two normalization
+    steps, only the readable images come back to the host.
+
     The coefficients used here (coeffs70 and coeffs_lungseg) are generated by opencxr team,
     using a private set of 50 CXR images as described in the Philipsen paper
     """
 
+    # in do_full_normalization the norm_70 image passed from step 1 to step 2 is stored as int16 (see get_norm_central_70),
+    # scaled so that -10, +10 maps to the int16 range (a resolution of ~3e-4, well below the error of the reconstruction)
+    norm_70_int16_scale = 3276.8
+    # lung segmentations covering less than this fraction of the image are taken to mean no lungs were found
+    min_lung_area_fraction = 0.005
+    # whether to do the energy band computations on the GPU (opt-in, requires cupy)
+    use_gpu = False
+    # the number of images normalized concurrently in do_full_normalization_batch. The statistics of the (6) energy
+    # bands of each image are already computed in a pool of their own, so more threads would oversubscribe the CPU
+    batch_workers = max(1, (os.cpu_count() or 1) // 6)
+
+    @classmethod
+    def get_array_modules(cls, arr):
+        """
+        Get the array module and ndimage module to process an array with
+        :param arr: the array to be processed
+        :return: cupy and cupyx.scipy.ndimage if arr is a cupy array, otherwise numpy and scipy.ndimage
+        """
+        if cupy is not None and isinstance(arr, cupy.ndarray):
+            return cupy, cupy_ndimage
+        return np, ndimage
+
+    @classmethod
+    def to_numpy(cls, arr):
+        """
+        Bring an array back to the host if it is on the GPU
+        :param arr: a numpy or cupy array
+        :return: the array as numpy array
+        """
+        if cupy is not None and isinstance(arr, cupy.ndarray):
+            return cupy.asnumpy(arr)
+        return arr
+
     @classmethod
     def split_energy_bands(cls, image, sigmas):
         """
         Split an np image to energy bands as described in section III.A of Philipsen et al, also reference [40] of that work.
+        Rather than filtering the full size image with ever larger sigmas, a Gaussian pyramid is built (Burt and Adelson):
+        at each level the image is blurred and downsampled by 2, so every level is filtered with the same small sigma.
+        The levels are then expanded back to the original size before the band differences are taken.
+        This changes the bands (and so the normalized images) compared to the original cascade, also away from the
+        image border (see test_normalization_regression in tests/test_utils.py). The reference coefficients
+        (coeffs70 and coeffs_lungseg) were fitted on the bands of the original cascade, and have not been re-derived
+        for the pyramid bands.
         :param image: the input image
         :param sigmas: The array of sigmas, set as per Philipsen at [1, 2, 4, 8, 16]
-        :return: The array of energy band images from 16 to 1, with the filtered image in the last place
+        :return: The (C-contiguous) array of energy band images from 16 to 1, with the filtered image in the first place
+                 (a cupy array if computed on the GPU, see use_gpu)
         """
+        if cls.use_gpu:
+            if cupy is None:
+                raise Exception("Normalizer.use_gpu is set but cupy is not installed")
+            image = cupy.asarray(image)
+        xp, xndimage = cls.get_array_modules(image)
 
-        bands = np.zeros((len(sigmas) + 1,) + image.shape)
+        # single precision is ample for the band arithmetic and halves the memory traffic
+        image = xp.asarray(image, dtype=xp.float32)
+        # the band buffer is allocated once and all full size results are written straight into it
+        bands = xp.empty((len(sigmas) + 1,) + image.shape, dtype=xp.float32)
 
-        curr_I_x = image
+        # bind the filters to locals once, rather than looking them up in every iteration
+        gaussian_filter = xndimage.gaussian_filter
+        zoom = xndimage.zoom
+
+        # build the pyramid, sigma is expressed relative to the (downsampled) size of each level
+        levels = [image]
         for sigma_ind, sigma in enumerate(sigmas):
-            curr_L_x = ndimage.filters.gaussian_filter(curr_I_x, sigma, mode="wrap")
+            # a kernel radius of 3 sigma (rather than the default 4) keeps all but ~0.3% of the Gaussian weight
+            curr_L_x = gaussian_filter(
+                levels[-1], sigma / 2**sigma_ind, mode="reflect", truncate=3.0
+            )
+            levels.append(zoom(curr_L_x, 0.5, order=1, mode="nearest"))
+
+        # expand each level back to the original image size, in place in the band buffer
+        # the bands are stored in reverse order of sigmas ([16,8,4,2,1]), so the level for sigma index i goes to
+        # position len(sigmas) - i and the returned buffer stays C-contiguous
+        bands[len(sigmas)] = image
+        for level_ind, level in enumerate(levels[1:], start=1):
+            zoom_factors = [
+                orig_size / level_size
+                for orig_size, level_size in zip(image.shape, level.shape)
+            ]
+            zoom(
+                level,
+                zoom_factors,
+                output=bands[len(sigmas) - level_ind],
+                order=1,
+                mode="nearest",
+            )
 
-            bands[sigma_ind] = curr_I_x - curr_L_x
+        # the band for each sigma is the difference of consecutive expanded levels
+        # when we have no sigmas left, the final filtered image stays in the first place (Fig 3 and reference [40])
+        for band_ind in range(len(sigmas), 0, -1):
+            xp.subtract(bands[band_ind], bands[band_ind - 1], out=bands[band_ind])
 
-            # when we have no sigmas left, store the final filtered image in the last band (Fig 3 and reference [40])
-            if sigma_ind == len(sigmas) - 1:
-                bands[sigma_ind + 1] = curr_L_x
+        return bands
 
-            curr_I_x = curr_L_x
+    @classmethod
+    def report_energy_band(cls, band, labels=None, nr_pixels=None):
+        """
+        returns the mean and stdev of a single energy band
+        :param band: one energy band from split_energy_bands method
+        :param labels: optional uint8 0/1 array marking the region of interest, if not given the whole band is used
+        :param nr_pixels: the number of pixels in the region of interest (counted from labels if not given)
+        :return: the mean and the std-dev
+        :raises ValueError: if labels is given but marks no pixels
+        """
+        if labels is None:
+            return float(band.mean()), float(band.std())
 
-        # return the bands in reverse order of sigmas ([16,8,4,2,1])
-        return bands[::-1]
+        xp, _ = cls.get_array_modules(band)
+        if nr_pixels is None:
+            nr_pixels = int(xp.count_nonzero(labels))
+        if nr_pixels == 0:
+            raise ValueError(
+                "The region of interest is empty, energy band statistics cannot be computed"
+            )
+        # weighted sums give the statistics of the region without copying out the masked values
+        # (unlike ndimage.mean/standard_deviation, which index out the labelled values internally)
+        mean = float(xp.einsum("ij,ij->", band, labels, dtype=xp.float64)) / nr_pixels
+        mean_sq = (
+            float(xp.einsum("ij,ij,ij->", band, band, labels, dtype=xp.float64))
+            / nr_pixels
+        )
+        return mean, np.sqrt(max(mean_sq - mean**2, 0))
 
     @classmethod
     def report_energy_bands(cls, bands, mask=1):
@@ -53,28 +169,43 @@ class Normalizer:
         given the energy bands of the image, and a region to focus on
         returns the means, stdevs of the energy bands in that region
         the stdevs are the "energy values" e_i_omega as used in formula 5 of Philipsen paper
+        The bands are reduced concurrently in a thread pool (numpy releases the GIL in the reductions)
         :param bands: energy bands from split_energy_bands method
         :param mask: region of interest (either central 70% of image, or a lung mask)
-        :return: a list of means and a list of std-devs
+        :return: an array of means and an array of std-devs (one value per band)
+        :raises ValueError: if the lung mask is empty
         """
-        means = []
-        stdevs = []
         shape = bands[0].shape
         if isinstance(
             mask, np.ndarray
         ):  # if the mask provided is an array (a lung mask)
-            for band in bands:
-                values = band[mask > 0]
-                means.append(values.mean())
-                stdevs.append(values.std())
+            xp, _ = cls.get_array_modules(bands)
+            # the region is labelled and counted once for all bands
+            labels = xp.asarray(mask > 0, dtype=xp.uint8)
+            nr_pixels = int(xp.count_nonzero(labels))
+            if nr_pixels == 0:
+                raise ValueError(
+                    "The lung mask is empty, energy band statistics cannot be computed"
+                )
+            with ThreadPoolExecutor(max_workers=len(bands)) as executor:
+                band_stats = list(
+                    executor.map(
+                        cls.report_energy_band,
+                        bands,
+                        [labels] * len(bands),
+                        [nr_pixels] * len(bands),
+                    )
+                )
         else:  # otherwise we have no lung mask, just use central 70% of the image
-            for band in bands:
-                sub_im = band[
-                    int(0.15 * shape[0]) : int(0.85 * shape[0]),
-                    int(0.15 * shape[1]) : int(0.85 * shape[1]),
-                ]
-                means.append(sub_im.mean())
-                stdevs.append(sub_im.std())
+            sub_ims = bands[
+                :,
+                int(0.15 * shape[0]) : int(0.85 * shape[0]),
+                int(0.15 * shape[1]) : int(0.85 * shape[1]),
+            ]
+            with ThreadPoolExecutor(max_workers=len(bands)) as executor:
+                band_stats = list(executor.map(cls.report_energy_band, sub_ims))
+        means = np.array([mean for mean, _ in band_stats])
+        stdevs = np.array([stdev for _, stdev in band_stats])
         return means, stdevs
 
     @classmethod
@@ -88,19 +219,54 @@ class Normalizer:
         :param coefficients: the coefficients which are constants derived from a reference dataset
         :return: The reconstructed normalized image
         """
-        bands[0] = (bands[0] - means[0]) / stdevs[0]
-        for j in range(1, bands.shape[0]):
-            bands[j] = bands[j] * coefficients[j] / stdevs[j]
-        return bands.sum(0)
+        # fold the per-band normalization into a single weight per band so that the weighted sum over all bands
+        # is done in one pass, without modifying the bands or creating a temporary per band
+        # (band 0 is not weighted by a coefficient)
+        scales = (np.asarray(coefficients) / np.asarray(stdevs)).astype(bands.dtype)
+        scales[0] = 1.0 / stdevs[0]
+        # with the pixels flattened this is a single matrix-vector product, which numpy hands to BLAS (vectorized, fused
+        # multiply-add) for any number of bands (or cupy to cuBLAS for bands on the GPU)
+        xp, _ = cls.get_array_modules(bands)
+        norm = xp.matmul(xp.asarray(scales), bands.reshape(bands.shape[0], -1))
+        norm -= means[0] / stdevs[0]
+        return norm.reshape(bands.shape[1:])
 
     @classmethod
-    def get_norm_central_70(cls, img_np, spacing):
+    def rescale_and_clip(cls, img_np, set_min, set_max, new_min, new_max, out=None):
+        """
+        Linearly rescales intensities from range set_min, set_max to range new_min, new_max
+        and clips values that end up outside the new range.
+        Uses in-place operations so that only the output image is allocated (nothing if out is given)
+        :param img_np: the input image
+        :param set_min: the value to map to new_min
+        :param set_max: the value to map to new_max
+        :param new_min: the minimum of the new range
+        :param new_max: the maximum of the new range
+        :param out: optional array to write the result to (may be img_np itself)
+        :return: The rescaled and clipped image
+        """
+        xp, _ = cls.get_array_modules(img_np)
+        scale = float(new_max - new_min) / float(set_max - set_min)
+        offset = new_min - scale * float(set_min)
+        out = xp.multiply(img_np, scale, out=out)
+        out += offset
+        xp.clip(out, new_min, new_max, out=out)
+        return out
+
+    @classmethod
+    def get_norm_central_70(cls, img_np, spacing, return_bands=False, quantize=False):
         """
         Get a normalized image based on central 70% of the image
         Will first crop the image (removing homogeneous black border regions) and resize it to 2048 wide (preserving aspect ratio)
         :param img_np: The input image to be normalized
         :param spacing: the spacing of the input image
-        :return: A normalized image for feeding to step 2 of the normalization algorithm (using a lung mask)
+        :param return_bands: if True, return the energy bands of the image (to be reused in step 2, see
+                             get_norm_lung_mask) in place of the norm_70 image, which is then not kept at all
+        :param quantize: if True, return the norm_70 image as int16, multiplied by norm_70_int16_scale (a quarter of
+                         the memory of the original float64 image). get_norm_lung_mask converts such images back.
+        :return: A normalized image for feeding to step 2 of the normalization algorithm (using a lung mask), as
+                 float32 (float64 in opencxr 1.2.0), or as int16 if quantize is set
+                 (or with return_bands the energy bands of the image; either is left on the GPU if use_gpu is set)
                  The same normalized image that is rescaled/clipped so that it is nicer to view
                  The spacing of the returned image
                  The list of size changes carried out for reference or future use (see utils __init__.py)
@@ -109,8 +275,8 @@ class Normalizer:
         coeffs70 = [1, 0.15046743, 0.09473514, 0.06337214, 0.0451897, 0.03574716]
         # 6 sigma bands as per the Philipsen paper.
         sigmas = sigmas = [1, 2, 4, 8, 16]
-        # make sure the image is float
-        img_np = img_np.astype(np.float64)
+        # make sure the image is float (single precision is sufficient for the normalization)
+        img_np = img_np.astype(np.float32)
         # crop away black borders
         img_np, size_changes_border_crop = crop_img_borders(
             img_np, in_thresh_factor=0.05
@@ -133,34 +299,68 @@ class Normalizer:
         img_mean = norm_70.mean()
         set_min = img_mean - 5.0
         set_max = img_mean + 5.0
-        readable_img = np.clip(
-            (new_max - new_min) * ((norm_70 - set_min) / (set_max - set_min)) + new_min,
+        # (if the bands are returned instead, norm_70 is not needed anymore so this is done in place)
+        readable_img = cls.rescale_and_clip(
+            norm_70,
+            set_min,
+            set_max,
             new_min,
             new_max,
+            out=norm_70 if return_bands else None,
         ).astype(np.uint16)
+        # the readable image goes to the lung segmentation, so it is needed on the host
+        readable_img = cls.to_numpy(readable_img)
 
         # combine all size changes in a single list to return
         size_changes_border_crop.extend(size_changes_2048)
 
+        if return_bands:
+            # return the bands for step2, the readable norm70, the new spacing, and the list of size changes
+            return bands, readable_img, new_spacing, size_changes_border_crop
+
+        if quantize:
+            # quantize the norm_70 image for the handoff to step 2 (int16 is half the size of float32)
+            xp, _ = cls.get_array_modules(norm_70)
+            norm_70 *= cls.norm_70_int16_scale
+            xp.rint(norm_70, out=norm_70)
+            xp.clip(norm_70, -32768, 32767, out=norm_70)
+            norm_70 = norm_70.astype(np.int16)
+
         # return the norm_70 for step2, the readable norm70, the new spacing, and the list of size changes
         return norm_70, readable_img, new_spacing, size_changes_border_crop
 
     @classmethod
-    def get_norm_lung_mask(cls, img_np_norm70, lung_mask_np):
+    def get_norm_lung_mask(cls, img_np_norm70, lung_mask_np, bands=None):
         """
         The second normalization step.  This takes the norm_70 image from get_norm_central_70, and a lung mask of it.
         The second normalization step is applied.
-        :param img_np_norm70: The input image, the first image returned by get_norm_central_70()
+        :param img_np_norm70: The input image, the first image returned by get_norm_central_70() (int16 values are
+                              converted back using norm_70_int16_scale). Ignored (may be None) if bands are given.
         :param lung_mask_np: The lung mask of the input image
-        :return: the final normalized image, scaled and clipped for best viewing
+        :param bands: optionally, the energy bands returned by get_norm_central_70(return_bands=True). If given these
+                      are reused rather than splitting img_np_norm70 into energy bands again.
+                      The norm_70 image is a per-band scaling of these bands (plus an offset on the low-pass band),
+                      and such scalings cancel out in reconstruct(), which divides every band by its own std-dev and
+                      subtracts the mean of the low-pass band. This is only an approximation though, as the Gaussian
+                      bands overlap. On the test images c0002, c0003 and c0005 (with a fixed two-rectangle lung mask as
+                      in tests/test_utils.py) the result differs from re-splitting norm_70 by a mean absolute difference
+                      of up to ~24, a 99th percentile of up to ~99 and a maximum of up to ~965 (on the 0-4095 range).
+        :return: the final normalized image, scaled and clipped for best viewing (always a numpy array)
+        :raises ValueError: if the lung mask is empty
         """
 
         # the coefficients lambda based on a reference set of 50 images (see formula 4 in Philipsen et al)
         coeffs_lungseg = [1, 0.26093275, 0.18805708, 0.13976646, 0.1033522, 0.07498657]
         # 6 sigma bands as per the Philipsen paper.
         sigmas = [1, 2, 4, 8, 16]
-        # split into energy bands
-        bands = cls.split_energy_bands(img_np_norm70, sigmas)
+        if bands is None:
+            # undo the quantization of the norm_70 image from step 1
+            if img_np_norm70.dtype == np.int16:
+                img_np_norm70 = img_np_norm70 * np.float32(
+                    1.0 / cls.norm_70_int16_scale
+                )
+            # split into energy bands
+            bands = cls.split_energy_bands(img_np_norm70, sigmas)
         # get means and stddevs of the energy bands
         means, stdevs = cls.report_energy_bands(bands, mask=lung_mask_np)
         # reconstruct from the energy bands and reference coefficients
@@ -174,42 +374,126 @@ class Normalizer:
         set_max = 5.0
 
         # rescale from range -5, +5 to 0,4095
-        # and clip values that end up outside that range
-        readable_img = np.clip(
-            (new_max - new_min) * ((norm - set_min) / (set_max - set_min)) + new_min,
-            new_min,
-            new_max,
+        # and clip values that end up outside that range (norm is not needed anymore so this is done in place)
+        readable_img = cls.rescale_and_clip(
+            norm, set_min, set_max, new_min, new_max, out=norm
         )
 
-        return readable_img
+        return cls.to_numpy(readable_img)
 
     @classmethod
-    def do_full_normalization(cls, img_in, spacing, lung_seg_algorithm):
+    def do_full_normalization(
+        cls, img_in, spacing, lung_seg_algorithm, reuse_bands=False
+    ):
         """
         Does full 2 step normalization including an intermediate lung segmentation
         :param img_in: The input image to be normalized
         :param spacing: The spacing of the input image
         :param lung_seg_algorithm: an instance of the lung segmentation algorithm
+        :param reuse_bands: if True, step 2 reuses the energy bands of step 1 rather than splitting the norm_70 image
+                            again. Faster, but an approximation (see get_norm_lung_mask), and the bands (~100MB) are
+                            kept in memory during the lung segmentation
         :return: The normalized image with larger axis at size 2048 pixels
                   The new spacing for the normalized image
                   The list of size changes carried out for reference or future use (see utils __init__.py)
+                  The lung segmentation mask used for step 2 (same size as the normalized image), so callers need not segment again
         """
 
-        # do norm step 1 (central 70%)
-        norm_70, readable_img, new_spacing, size_changes = cls.get_norm_central_70(
-            img_in, spacing
+        # do norm step 1 (central 70%), this gives the norm_70 image as int16 (or its energy bands if reused) for step 2
+        step_1_img, readable_img, new_spacing, size_changes = cls.get_norm_central_70(
+            img_in, spacing, return_bands=reuse_bands, quantize=True
         )
 
         # do a lung segmentation on the norm image
         lung_seg_mask = lung_seg_algorithm.run(readable_img)
 
-        # if the lung seg mask is completely empty this is probably not a lung image at all so we should fail gracefully
-        # i.e. return an empty image
-        if np.max(lung_seg_mask) == 0:
-            print("lung seg finds no lung so cxr standardization returning empty image")
-            return lung_seg_mask, new_spacing, size_changes
-
         # do norm step 2 using the lung segmentation image
-        final_norm_img = cls.get_norm_lung_mask(norm_70, lung_seg_mask)
+        final_norm_img = cls.normalize_with_lung_seg(
+            step_1_img, lung_seg_mask, reuse_bands
+        )
+
+        return final_norm_img, new_spacing, size_changes, lung_seg_mask
+
+    @classmethod
+    def do_full_normalization_batch(
+        cls, imgs_in, spacings, lung_seg_algorithm, batch_size=4, reuse_bands=False
+    ):
+        """
+        Does full 2 step normalization (as do_full_normalization) on a list of images
+        The images are processed in chunks of batch_size, as the result of step 1 of each image is kept until its
+        step 2 is done (~100MB per image if reuse_bands is set). The lung segmentations of a chunk are done with a single call to the lung segmentation
+        algorithm, and the normalization steps for the images of a chunk are run concurrently in a thread pool of
+        batch_workers threads (the heavy numpy/scipy work releases the GIL)
+        :param imgs_in: list of input images to be normalized
+        :param spacings: list of spacings of the input images
+        :param lung_seg_algorithm: an instance of the lung segmentation algorithm
+        :param batch_size: the maximum number of images to process at once
+        :param reuse_bands: whether step 2 reuses the energy bands of step 1 (see do_full_normalization)
+        :return: A list with, per image, the same values as returned by do_full_normalization
+        """
+
+        norm_results = []
+        for start in range(0, len(imgs_in), batch_size):
+            # do norm step 1 (central 70%) for the images of this chunk
+            with ThreadPoolExecutor(max_workers=cls.batch_workers) as executor:
+                step_1_results = list(
+                    executor.map(
+                        lambda img_in, spacing: cls.get_norm_central_70(
+                            img_in, spacing, return_bands=reuse_bands, quantize=True
+                        ),
+                        imgs_in[start : start + batch_size],
+                        spacings[start : start + batch_size],
+                    )
+                )
+            step_1_imgs, readable_imgs, new_spacings, size_changes_list = (
+                list(values) for values in zip(*step_1_results)
+            )
+            # only step_1_imgs holds on to the step 1 results now, see normalize_image below
+            del step_1_results
+
+            # do the lung segmentations of all the norm images of this chunk as one batch
+            lung_seg_masks = lung_seg_algorithm.run_batch(readable_imgs)
+            del readable_imgs
+
+            def normalize_image(index):
+                # take the step 1 result out of the list so that it is freed as soon as step 2 of this image is done
+                step_1_img = step_1_imgs[index]
+                step_1_imgs[index] = None
+                return cls.normalize_with_lung_seg(
+                    step_1_img, lung_seg_masks[index], reuse_bands
+                )
+
+            # do norm step 2 using the lung segmentation images and the results of step 1
+            with ThreadPoolExecutor(max_workers=cls.batch_workers) as executor:
+                final_norm_imgs = list(
+                    executor.map(normalize_image, range(len(step_1_imgs)))
+                )
+
+            # per image: the final normalized image, the new spacing, the size changes and the lung segmentation
+            norm_results.extend(
+                zip(final_norm_imgs, new_spacings, size_changes_list, lung_seg_masks)
+            )
+
+        return norm_results
+
+    @classmethod
+    def normalize_with_lung_seg(cls, step_1_img, lung_seg_mask, is_bands=False):
+        """
+        Does norm step 2 (get_norm_lung_mask) unless the lung segmentation is (nearly) empty
+        :param step_1_img: The norm_70 image from get_norm_central_70(), or its energy bands if is_bands is set
+        :param lung_seg_mask: The lung segmentation of the readable norm_70 image
+        :param is_bands: whether step_1_img holds the energy bands from get_norm_central_70(return_bands=True)
+        :return: The final normalized image, or an empty image if no lungs were found
+        """
+        # if the lung seg mask is empty, or too small to be a pair of lungs, this is probably not a lung image at all
+        # so we should fail gracefully, i.e. return an empty image (without running step 2 on a degenerate mask)
+        if (
+            np.count_nonzero(lung_seg_mask)
+            < cls.min_lung_area_fraction * lung_seg_mask.size
+        ):
+            print("lung seg finds no lung so cxr standardization returning empty image")
+            return np.zeros(lung_seg_mask.shape, dtype=np.float32)
 
-        return final_norm_img, new_spacing, size_changes
+        if is_bands:
+            return cls.get_norm_lung_mask(None, lung_seg_mask, bands=step_1_img)
+        return cls.get_norm_lung_mask(step_1_img, lung_seg_mask)
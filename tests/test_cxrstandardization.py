@@ -57,5 +57,65 @@ def test_cxrstandardization():
     assert passed
 
 
+def test_cxrstandardization_batch():
+    # read in three images and standardize them as a batch
+    img_names = ["c0002.mha", "c0003.mha", "c0005.mha"]
+    imgs_np = []
+    spacings = []
+    for img_name in img_names:
+        f_in = Path(__file__).parent / "resources" / "images" / img_name
+        img_np, spacing, pydata = read_file(str(f_in.resolve()))
+        imgs_np.append(img_np)
+        spacings.append(spacing)
+    # load the standardization algorithm
+    cxrstandardize_algorithm = opencxr.load(opencxr.algorithms.cxr_standardize)
+
+    # run the standardization algorithm on the list of images, in chunks of 2 images
+    # this will return, for each image, the new image, the new spacing, and a dict of size changes carried out
+    results = cxrstandardize_algorithm.run_batch(imgs_np, spacings, batch_size=2)
+
+    passed = len(results) == len(img_names)
+    for img_name, img_np, spacing, (final_norm_img, new_spacing, size_changes) in zip(
+        img_names, imgs_np, spacings, results
+    ):
+        # the batch result should be the same as running the algorithm on the single image
+        # (the lung segmentation model may differ by rounding when run on a batch, so allow a small difference)
+        single_norm_img, single_spacing, single_size_changes = (
+            cxrstandardize_algorithm.run(img_np, spacing)
+        )
+        mean_abs_diff = np.mean(
+            np.abs(final_norm_img.astype(np.float64) - single_norm_img)
+        )
+        if not size_changes == single_size_changes:
+            print(img_name, "batch size changes differ from run()")
+            passed = False
+        if not new_spacing == single_spacing:
+            print(img_name, "batch spacing differs from run()", new_spacing)
+            passed = False
+        if not mean_abs_diff < 1.0:
+            print(img_name, "batch image differs from run()", mean_abs_diff)
+            passed = False
+
+        # verify the size changes reproduce the output size and spacing as in the single image test
+        img_resized_to_test, new_spacing_to_test = apply_size_changes_to_img(
+            img_np, spacing, size_changes
+        )
+        passed = (
+            passed
+            and final_norm_img.shape == (1024, 1024)
+            and not np.max(final_norm_img) == 0
+            and (final_norm_img.shape == img_resized_to_test.shape)
+            and (new_spacing == new_spacing_to_test)
+        )
+
+    if passed:
+        print("CXR Standardization batch test completed successfully")
+    else:
+        print("CXR Standardization batch test failed")
+
+    assert passed
+
+
 if __name__ == "__main__":
     test_cxrstandardization()
+    test_cxrstandardization_batch()
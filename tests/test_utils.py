@@ -3,6 +3,8 @@
 
 @author: keelin
 """
+
+import importlib.util
 import os.path
 from pathlib import Path
 from opencxr.utils.file_io import read_file, write_file
@@ -19,7 +21,9 @@ from opencxr.utils.rotate_flip_invert import (
     invert_grayscale,
 )
 from opencxr.utils import reverse_size_changes_to_img
+from opencxr.utils.normalization import Normalizer
 import numpy as np
+import pytest
 
 
 def test_file_io():
@@ -192,7 +196,214 @@ def test_rotate_flip_invert():
     assert passing
 
 
+def get_fixed_lung_mask(shape):
+    # a fixed lung mask, two rectangles, so that the tests do not depend on the lung segmentation model
+    h, w = shape
+    lung_mask = np.zeros((h, w), np.uint8)
+    lung_mask[h // 5 : 4 * h // 5, w // 8 : 7 * w // 16] = 1
+    lung_mask[h // 5 : 4 * h // 5, 9 * w // 16 : 7 * w // 8] = 1
+    return lung_mask
+
+
+def test_energy_bands_reconstruct():
+    # the energy bands are differences of successive pyramid levels, so together with the filtered image
+    # in the first place they should add up to the input image again
+    f_in_mha = Path(__file__).parent / "resources" / "images" / "c0002.mha"
+    f_in_mha = str(f_in_mha.resolve())
+    img_np, _, _ = read_file(f_in_mha)
+    img_np = img_np.astype(np.float32)
+
+    bands = Normalizer.split_energy_bands(img_np, [1, 2, 4, 8, 16])
+
+    passing = True
+    if not bands.shape == (6,) + img_np.shape:
+        print("energy bands wrong shape", bands.shape)
+        passing = False
+    max_diff = np.max(np.abs(bands.sum(0) - img_np))
+    if not max_diff < 1e-5 * np.max(img_np):
+        print("energy bands do not add up to the input image", max_diff)
+        passing = False
+
+    assert passing
+
+
+@pytest.mark.parametrize("img_name", ["c0002", "c0003", "c0005"])
+def test_normalization_regression(img_name):
+    # compare the normalization output to that of the original implementation (filtering the full size image with
+    # every sigma, in float64, see Philipsen et al), stored as 4x4 block means to keep the resources small.
+    # The Gaussian pyramid changes the output throughout the image: at least 64 pixels from the border by ~35 grey
+    # levels on average (99th percentile ~150, up to ~300 in the lungs), and by much more (up to ~2600) in a band along
+    # the border, where the reflect boundary mode also differs from the original.
+    # The bounds are set from the worst case over the test images.
+    f_in_mha = Path(__file__).parent / "resources" / "images" / (img_name + ".mha")
+    f_in_mha = str(f_in_mha.resolve())
+    img_np, spacing, _ = read_file(f_in_mha)
+    f_in_baseline = (
+        Path(__file__).parent
+        / "resources"
+        / "images"
+        / (img_name + "_norm_baseline_4x.png")
+    )
+    f_in_baseline = str(f_in_baseline.resolve())
+    baseline_np, _, _ = read_file(f_in_baseline)
+
+    norm_70, readable_img, _, _ = Normalizer.get_norm_central_70(img_np, spacing)
+    norm_img = Normalizer.get_norm_lung_mask(
+        norm_70, get_fixed_lung_mask(readable_img.shape)
+    )
+    h, w = baseline_np.shape
+    norm_img_4x = (
+        norm_img[: h * 4, : w * 4].astype(np.float64).reshape(h, 4, w, 4).mean((1, 3))
+    )
+    abs_diff = np.abs(norm_img_4x - baseline_np)
+    # at least 64 pixels (at full size) from the image border
+    abs_diff_interior = abs_diff[16:-16, 16:-16]
+
+    passing = True
+    if not abs_diff.mean() < 70:
+        print(
+            img_name,
+            "normalization mean abs diff to baseline too large",
+            abs_diff.mean(),
+        )
+        passing = False
+    if not np.percentile(abs_diff, 99) < 1250:
+        print(
+            img_name,
+            "normalization 99th percentile abs diff to baseline too large",
+            np.percentile(abs_diff, 99),
+        )
+        passing = False
+    if not abs_diff_interior.mean() < 45:
+        print(
+            img_name,
+            "normalization interior mean abs diff to baseline too large",
+            abs_diff_interior.mean(),
+        )
+        passing = False
+    if not abs_diff_interior.max() < 350:
+        print(
+            img_name,
+            "normalization interior max abs diff to baseline too large",
+            abs_diff_interior.max(),
+        )
+        passing = False
+
+    assert passing
+
+
+def test_energy_bands_empty_mask():
+    # statistics over an empty lung mask are undefined, this should be reported clearly
+    bands = np.random.rand(6, 64, 64).astype(np.float32)
+    try:
+        Normalizer.report_energy_bands(bands, mask=np.zeros((64, 64), np.uint8))
+        raised = False
+    except ValueError:
+        raised = True
+    if not raised:
+        print("report_energy_bands did not raise ValueError for an empty mask")
+
+    assert raised
+
+
+@pytest.mark.parametrize("img_name", ["c0002.mha", "c0003.mha", "c0005.mha"])
+def test_norm_lung_mask_band_reuse(img_name):
+    # step 2 of the normalization can reuse the energy bands of step 1 rather than splitting norm_70 again
+    # this is an approximation, check it stays close to the result of re-splitting
+    # (the bounds are set from the worst case over the test images, see get_norm_lung_mask)
+    f_in_mha = Path(__file__).parent / "resources" / "images" / img_name
+    f_in_mha = str(f_in_mha.resolve())
+    img_np, spacing, _ = read_file(f_in_mha)
+
+    norm_70, readable_img, _, _ = Normalizer.get_norm_central_70(img_np, spacing)
+    bands, readable_img_bands, _, _ = Normalizer.get_norm_central_70(
+        img_np, spacing, return_bands=True
+    )
+
+    lung_mask = get_fixed_lung_mask(readable_img.shape)
+
+    norm_resplit = Normalizer.get_norm_lung_mask(norm_70, lung_mask)
+    norm_reuse = Normalizer.get_norm_lung_mask(None, lung_mask, bands=bands)
+    abs_diff = np.abs(norm_resplit.astype(np.float64) - norm_reuse)
+
+    passing = True
+    if not np.array_equal(readable_img, readable_img_bands):
+        print("readable norm_70 image differs when returning bands")
+        passing = False
+    if not abs_diff.mean() < 30:
+        print(img_name, "band reuse mean abs diff too large", abs_diff.mean())
+        passing = False
+    if not np.percentile(abs_diff, 99) < 125:
+        print(
+            img_name,
+            "band reuse 99th percentile abs diff too large",
+            np.percentile(abs_diff, 99),
+        )
+        passing = False
+    if not abs_diff.max() < 1200:
+        print(img_name, "band reuse max abs diff too large", abs_diff.max())
+        passing = False
+
+    assert passing
+
+
+def test_normalization_gpu():
+    # the GPU path (Normalizer.use_gpu) should give the same result as the CPU path, up to float32 rounding
+    # (the readable uint16 images may differ by a grey level where rounding differences cross an integer)
+    pytest.importorskip("cupy")
+    f_in_mha = Path(__file__).parent / "resources" / "images" / "c0002.mha"
+    f_in_mha = str(f_in_mha.resolve())
+    img_np, spacing, _ = read_file(f_in_mha)
+
+    norm_70_cpu, readable_img_cpu, _, _ = Normalizer.get_norm_central_70(
+        img_np, spacing
+    )
+    lung_mask = get_fixed_lung_mask(readable_img_cpu.shape)
+    norm_img_cpu = Normalizer.get_norm_lung_mask(norm_70_cpu, lung_mask)
+
+    Normalizer.use_gpu = True
+    try:
+        norm_70_gpu, readable_img_gpu, _, _ = Normalizer.get_norm_central_70(
+            img_np, spacing
+        )
+        norm_img_gpu = Normalizer.get_norm_lung_mask(norm_70_gpu, lung_mask)
+    finally:
+        Normalizer.use_gpu = False
+
+    readable_diff = np.abs(
+        readable_img_cpu.astype(np.float64) - readable_img_gpu.astype(np.float64)
+    )
+    norm_diff = np.abs(norm_img_cpu.astype(np.float64) - norm_img_gpu)
+
+    passing = True
+    if not isinstance(norm_img_gpu, np.ndarray):
+        print("GPU normalization did not return a numpy array")
+        passing = False
+    if not (readable_diff.mean() < 0.5 and readable_diff.max() <= 5):
+        print(
+            "GPU readable norm_70 image differs from CPU",
+            readable_diff.mean(),
+            readable_diff.max(),
+        )
+        passing = False
+    if not (norm_diff.mean() < 0.5 and norm_diff.max() <= 5):
+        print(
+            "GPU normalized image differs from CPU", norm_diff.mean(), norm_diff.max()
+        )
+        passing = False
+
+    assert passing
+
+
 if __name__ == "__main__":
     test_file_io()
     test_mask_crop()
     test_rotate_flip_invert()
+    test_energy_bands_reconstruct()
+    for img_name in ["c0002", "c0003", "c0005"]:
+        test_normalization_regression(img_name)
+    test_energy_bands_empty_mask()
+    for img_name in ["c0002.mha", "c0003.mha", "c0005.mha"]:
+        test_norm_lung_mask_band_reuse(img_name)
+    if importlib.util.find_spec("cupy") is not None:
+        test_normalization_gpu()